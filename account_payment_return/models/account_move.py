@@ -81,6 +81,18 @@ class AccountMoveLine(models.Model):
         column2="partial_reconcile_id",
     )
 
+    def init(self):
+        super().init()
+        # Partial index for the reconciled move line lookups done when
+        # matching payment return lines by reference
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS account_move_line_name_reconciled_index
+            ON account_move_line (name)
+            WHERE reconciled = true
+            """
+        )
+
 
 class AccountPartialReconcile(models.Model):
     _inherit = "account.partial.reconcile"
@@ -7,6 +7,8 @@
 # Copyright 2022 NuoBiT Solutions, S.L. - Eric Antones <eantones@nuobit.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from collections import defaultdict
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError, ValidationError
 from odoo.tools import float_compare
@@ -84,15 +86,32 @@ class PaymentReturn(models.Model):
         allowing to detect the unreconciled "done" payment returns with
         automatic reconciliation enabled.
         """
+        eligible = self.filtered(
+            lambda rec: rec.state == "done" and rec.journal_id.return_auto_reconcile
+        )
+        unreconciled_move_ids = set()
+        if eligible:
+            groups = self.env["account.move.line"].read_group(
+                [("move_id", "in", eligible.mapped("move_id").ids), ("credit", ">", 0)],
+                ["move_id", "reconciled"],
+                ["move_id", "reconciled"],
+                lazy=False,
+            )
+            unreconciled_move_ids = {
+                group["move_id"][0] for group in groups if not group["reconciled"]
+            }
         for rec in self:
-            if rec.state == "done" and rec.journal_id.return_auto_reconcile:
-                crdt_move_line = rec.move_id.line_ids.filtered(lambda l: l.credit)
-                rec.auto_reconcile_failure = not crdt_move_line.reconciled
-            else:
-                rec.auto_reconcile_failure = False
+            rec.auto_reconcile_failure = (
+                rec in eligible and rec.move_id.id in unreconciled_move_ids
+            )
 
     @api.constrains("line_ids")
     def _check_duplicate_move_line(self):
+        # Nothing to check (nor to query) until move lines are attached,
+        # which is the common case right after an import
+        if not self.mapped("line_ids.move_line_ids"):
+            return
+
         def append_error(error_line):
             error_list.append(
                 _("Payment Line: %s (%s) in Payment Return: %s")
@@ -104,20 +123,37 @@ class PaymentReturn(models.Model):
             )
 
         error_list = []
-        all_move_lines = self.env["account.move.line"]
+        seen_move_line_ids = set()
         for line in self.mapped("line_ids"):
-            for move_line in line.move_line_ids:
-                if move_line in all_move_lines:
+            for move_line_id in line.move_line_ids.ids:
+                if move_line_id in seen_move_line_ids:
                     append_error(line)
-                all_move_lines |= move_line
-        if (not error_list) and all_move_lines:
-            duplicate_lines = self.env["payment.return.line"].search(
-                [
-                    ("move_line_ids", "in", all_move_lines.ids),
-                    ("return_id.state", "=", "done"),
-                ]
+                else:
+                    seen_move_line_ids.add(move_line_id)
+        if (not error_list) and seen_move_line_ids:
+            # A ('move_line_ids', 'in', ids) domain expands into a huge IN
+            # list for returns with many lines; query the relation table
+            # directly to keep the plan selective
+            self.env["payment.return.line"].flush(["move_line_ids", "return_id"])
+            self.flush(["state"])
+            self.env.cr.execute(
+                """
+                SELECT rel.payment_return_line_id
+                FROM account_move_line_payment_return_line_rel rel
+                JOIN payment_return_line prl
+                    ON prl.id = rel.payment_return_line_id
+                JOIN payment_return pr ON pr.id = prl.return_id
+                WHERE rel.account_move_line_id = ANY(%s)
+                    AND pr.state = 'done'
+                """,
+                (list(seen_move_line_ids),),
+            )
+            duplicate_lines = self.env["payment.return.line"].browse(
+                [row[0] for row in self.env.cr.fetchall()]
             )
             if duplicate_lines:
+                # Prefetch the fields used in the error message in one go
+                duplicate_lines.mapped("move_line_ids.name")
                 for line in duplicate_lines:
                     append_error(line)
         if error_list:
@@ -127,16 +163,27 @@ class PaymentReturn(models.Model):
 
     @api.depends("line_ids.amount")
     def _compute_total_amount(self):
-        return_line_model = self.env["payment.return.line"]
-        domain = [("return_id", "in", self.ids)]
-        res = return_line_model.read_group(
-            domain=domain, fields=["return_id", "amount"], groupby=["return_id"]
-        )
+        # Most accesses come from a single form view record (or an
+        # onchange NewId); sum the lines from cache and skip the SQL
+        if len(self) == 1:
+            self.total_amount = sum(self.line_ids.mapped("amount"))
+            return
+        # A read_group grouped by a many2one would order the groups using
+        # the comodel's _order, joining payment_return for nothing, so
+        # aggregate directly on the lines table instead.
         lines_dict = {}
-        for dic in res:
-            return_id = dic["return_id"][0]
-            total_amount = dic["amount"]
-            lines_dict[return_id] = total_amount
+        if self.ids:
+            self.env["payment.return.line"].flush(["return_id", "amount"])
+            self.env.cr.execute(
+                """
+                SELECT return_id, SUM(amount)
+                FROM payment_return_line
+                WHERE return_id IN %s
+                GROUP BY return_id
+                """,
+                (tuple(self.ids),),
+            )
+            lines_dict = dict(self.env.cr.fetchall())
         for rec in self:
             rec.total_amount = lines_dict.get(rec.id, 0.0)
 
@@ -147,7 +194,7 @@ class PaymentReturn(models.Model):
         return {"returned_payment": True}
 
     def unlink(self):
-        if self.filtered(lambda x: x.state == "done"):
+        if self.search_count([("id", "in", self.ids), ("state", "=", "done")]):
             raise UserError(_("You can not remove a payment return if state is 'Done'"))
         return super(PaymentReturn, self).unlink()
 
@@ -171,13 +218,15 @@ class PaymentReturn(models.Model):
             "company_id": self.company_id.id,
         }
 
-    def _prepare_move_line(self, move, total_amount):
+    def _prepare_move_line(self, move, total_amount, credit_account_id=None):
         self.ensure_one()
+        if credit_account_id is None:
+            credit_account_id = self.journal_id.payment_credit_account_id.id
         return {
             "name": move.ref,
             "debit": 0.0,
             "credit": total_amount,
-            "account_id": self.journal_id.payment_credit_account_id.id,
+            "account_id": credit_account_id,
             "move_id": move.id,
             "journal_id": move.journal_id.id,
         }
@@ -190,79 +239,115 @@ class PaymentReturn(models.Model):
         self.ensure_one()
         if not self.journal_id.return_auto_reconcile:
             return
-        rounding = self.env.user.company_id.currency_id.rounding
-        counterpart_move_lines = self.env["account.move.line"].browse()
+        # The return's own company rounding, fetched once for the whole call
+        rounding = self.company_id.currency_id.rounding
+        counterpart_ids = []
         for move_line in all_move_lines:
-            move = move_line.move_id
-            if len(move.line_ids) != 2:  # auto.reconciliation not possible
+            line_ids = move_line.move_id.line_ids.ids
+            if len(line_ids) != 2:  # auto.reconciliation not possible
                 return
-            counterpart_move_lines |= move.line_ids.filtered(
-                lambda line: line != move_line
-            )
+            counterpart_ids.extend(set(line_ids) - {move_line.id})
+        if not counterpart_ids:
+            return
+        # Aggregate debit total and reconciled flag on the server instead
+        # of reading every counterpart line
+        groups = self.env["account.move.line"].read_group(
+            [("id", "in", counterpart_ids)],
+            ["debit:sum", "reconciled:bool_or"],
+            ["account_id"],
+            lazy=False,
+        )
+        if len(groups) != 1:  # all lines must share a single account
+            return
+        group = groups[0]
         if (
-            counterpart_move_lines
-            and float_compare(
-                total_amount,
-                sum(counterpart_move_lines.mapped("debit")),
-                precision_rounding=rounding,
-            )
+            group["account_id"][0] == credit_move_line.account_id.id
+            and float_compare(total_amount, group["debit"], precision_rounding=rounding)
             == 0
-            and not any(rec.reconciled for rec in counterpart_move_lines)
+            and not group["reconciled"]
         ):
-            lines_to_reconcile = credit_move_line | counterpart_move_lines
-            if len(lines_to_reconcile.mapped("account_id")) != 1:
-                return
+            lines_to_reconcile = credit_move_line | self.env[
+                "account.move.line"
+            ].browse(counterpart_ids)
             lines_to_reconcile.reconcile()
 
     def action_confirm(self):
         self.ensure_one()
+        # Re-validate at the boundary: line-level writes (matchers,
+        # imports) do not trigger the line_ids constraint
+        self._check_duplicate_move_line()
         # Check for incomplete lines
-        if self.line_ids.filtered(lambda x: not x.move_line_ids):
+        if self.env["payment.return.line"].search_count(
+            [("return_id", "=", self.id), ("move_line_ids", "=", False)]
+        ):
             raise UserError(
                 _("You must input all moves references in the payment return.")
             )
         invoices = self.env["account.move"]
         move_line_model = self.env["account.move.line"]
+        # Journal data is invariant for the whole confirmation
+        journal = self.journal_id
         move = self.env["account.move"].create(self._prepare_return_move_vals())
-        total_amount = 0.0
         all_move_lines = self.env["account.move.line"]
-        # First loop to generate the move lines and compute the total amount
-        return_line_map = {}
-        for return_line in self.line_ids:
-            move_line2_vals = return_line._prepare_return_move_line_vals(move)
-            move_line2 = move_line_model.with_context(check_move_validity=False).create(
-                move_line2_vals
-            )
-            total_amount += move_line2.debit
-            return_line_map[return_line] = move_line2
-        move_line_vals = self._prepare_move_line(move, total_amount)
+        # Generate the return move lines in one batched create and compute
+        # the total amount from the result
+        move_lines2 = move_line_model.with_context(check_move_validity=False).create(
+            [
+                return_line._prepare_return_move_line_vals(move)
+                for return_line in self.line_ids
+            ]
+        )
+        total_amount = sum(move_lines2.mapped("debit"))
+        return_line_map = dict(zip(self.line_ids, move_lines2))
+        move_line_vals = self._prepare_move_line(
+            move, total_amount, journal.payment_credit_account_id.id
+        )
         # credit_move_line: credit on transfer or bank account
         credit_move_line = move_line_model.create(move_line_vals)
         move._post()
+        # Prime the prefetch cache so the loop below does not trigger one
+        # SELECT per move line when walking the reconciliation chain
+        self.line_ids.mapped("move_line_ids.matched_debit_ids.debit_move_id.move_id")
+        lines_to_reconcile = defaultdict(lambda: self.env["account.move.line"])
+        returned_moves_map = {}
+        expense_lines_vals = []
+        extra_lines_vals = []
         for return_line in self.line_ids:
             move_line2 = return_line_map[return_line]
+            # move_line_ids: credit on customer account (from payment move)
+            # returned_moves: debit on customer account (from invoice move)
+            returned_moves = return_line.move_line_ids.mapped(
+                "matched_debit_ids.debit_move_id"
+            )
+            returned_moves_map[return_line] = returned_moves
+            all_move_lines |= return_line.move_line_ids
+            invoices |= returned_moves.mapped("move_id")
             for move_line in return_line.move_line_ids:
-                # move_line: credit on customer account (from payment move)
-                # returned_moves: debit on customer account (from invoice move)
-                returned_moves = move_line.matched_debit_ids.mapped("debit_move_id")
-                all_move_lines |= move_line
-                invoices |= returned_moves.mapped("move_id")
-                move_line.remove_move_reconcile()
-                (move_line | move_line2).with_context(
-                    check_move_validity=False
-                ).reconcile()
-                return_line.move_line_ids.mapped("matched_debit_ids").write(
-                    {"origin_returned_move_ids": [(6, 0, returned_moves.ids)]}
-                )
+                # Reconciliation can only net lines sharing account and
+                # partner, so that pair is the widest safe grouping
+                key = (move_line.account_id.id, move_line.partner_id.id)
+                lines_to_reconcile[key] |= move_line | move_line2
             if return_line.expense_amount:
-                expense_lines_vals = return_line._prepare_expense_lines_vals(move)
-                move_line_model.with_context(check_move_validity=False).create(
-                    expense_lines_vals
-                )
-            extra_lines_vals = return_line._prepare_extra_move_lines(move)
+                expense_lines_vals.extend(return_line._prepare_expense_lines_vals(move))
+            extra_lines_vals.extend(return_line._prepare_extra_move_lines(move))
+        if expense_lines_vals:
+            move_line_model.with_context(check_move_validity=False).create(
+                expense_lines_vals
+            )
+        if extra_lines_vals:
             move_line_model.create(extra_lines_vals)
+        # Unreconcile the payments and reconcile them with the return lines
+        # in one pass per (account, partner) instead of once per move line
+        all_move_lines.remove_move_reconcile()
+        for lines in lines_to_reconcile.values():
+            lines.with_context(check_move_validity=False).reconcile()
+        for return_line, returned_moves in returned_moves_map.items():
+            return_line.move_line_ids.mapped("matched_debit_ids").write(
+                {"origin_returned_move_ids": [(6, 0, returned_moves.ids)]}
+            )
         # Reconcile (if option enabled)
-        self._auto_reconcile(credit_move_line, all_move_lines, total_amount)
+        if journal.return_auto_reconcile:
+            self._auto_reconcile(credit_move_line, all_move_lines, total_amount)
         # Write directly because we returned payments just now
         invoices.write(self._prepare_invoice_returned_vals())
         self.write({"state": "done", "move_id": move.id})
@@ -341,17 +426,58 @@ class PaymentReturnLine(models.Model):
         domain=[("supplier_rank", ">", 0)],
     )
 
+    def init(self):
+        super().init()
+        # Partial index backing the reference matching in _find_match
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS payment_return_line_reference_index
+            ON payment_return_line (reference)
+            WHERE reference IS NOT NULL
+            """
+        )
+
     def _compute_amount(self):
+        amounts = {}
+        if self.ids:
+            # Sum the credits in SQL rather than loading every move line
+            self.flush(["move_line_ids"])
+            self.env["account.move.line"].flush(["credit"])
+            self.env.cr.execute(
+                """
+                SELECT rel.payment_return_line_id, SUM(aml.credit)
+                FROM account_move_line_payment_return_line_rel rel
+                JOIN account_move_line aml
+                    ON aml.id = rel.account_move_line_id
+                WHERE rel.payment_return_line_id = ANY(%s)
+                GROUP BY rel.payment_return_line_id
+                """,
+                (self.ids,),
+            )
+            amounts = dict(self.env.cr.fetchall())
         for line in self:
-            line.amount = sum(line.move_line_ids.mapped("credit"))
+            if line.id in amounts:
+                line.amount = amounts[line.id]
+            else:
+                # New (onchange) records and lines without move lines
+                line.amount = sum(line.move_line_ids.mapped("credit"))
 
     def _get_partner_from_move(self):
-        for line in self.filtered(lambda x: not x.partner_id):
+        lines = self.filtered(lambda x: not x.partner_id)
+        if not lines:
+            return
+        # Prefetch every involved partner in one query
+        lines.mapped("move_line_ids.partner_id")
+        lines_by_partner = defaultdict(lambda: self.env["payment.return.line"])
+        for line in lines:
             partners = line.move_line_ids.mapped("partner_id")
             if len(partners) > 1:
                 raise UserError(_("All payments must be owned by the same partner"))
-            line.partner_id = partners[:1].id
-            line.partner_name = partners[:1].name
+            lines_by_partner[partners[:1]] |= line
+        for partner, partner_lines in lines_by_partner.items():
+            partner_lines.write(
+                {"partner_id": partner.id, "partner_name": partner.name}
+            )
 
     @api.onchange("move_line_ids")
     def _onchange_move_line(self):
@@ -364,11 +490,40 @@ class PaymentReturnLine(models.Model):
             self.expense_account = journal.default_expense_account_id
             self.expense_partner_id = journal.default_expense_partner_id
 
+    def _get_match_references(self):
+        return [ref for ref in set(self.mapped("reference")) if ref]
+
+    def _write_matches(self, matches):
+        """Write the matched move lines grouped by assigned values.
+
+        :param matches: list of (line, move line ids, concept) tuples,
+            concept being falsy when the line must keep its current one.
+        """
+        grouped = defaultdict(lambda: self.env["payment.return.line"])
+        for line, move_line_ids, concept in matches:
+            grouped[(tuple(move_line_ids), concept)] |= line
+        for (move_line_ids, concept), lines in grouped.items():
+            vals = {"move_line_ids": [(6, 0, list(move_line_ids))]}
+            if concept:
+                vals["concept"] = concept
+            lines.write(vals)
+
     def match_invoice(self):
+        references = self._get_match_references()
+        if not references:
+            return
+        invoices = self.env["account.move"].search(
+            [("name", "in", references), ("move_type", "=", "out_invoice")]
+        )
+        # Prefetch the reconciliation chains of all candidates at once
+        invoices.mapped("line_ids.matched_debit_ids.debit_move_id")
+        invoices.mapped("line_ids.matched_credit_ids.credit_move_id")
+        matches = []
         for line in self:
-            domain = line.partner_id and [("partner_id", "=", line.partner_id.id)] or []
-            domain += [("name", "=", line.reference), ("move_type", "=", "out_invoice")]
-            invoice = self.env["account.move"].search(domain)
+            invoice = invoices.filtered(
+                lambda inv: inv.name == line.reference
+                and (not line.partner_id or inv.partner_id == line.partner_id)
+            )
             if invoice:
                 invoice_line_ids = invoice.line_ids.filtered(
                     lambda line: line.account_id.user_type_id.type
@@ -381,60 +536,88 @@ class PaymentReturnLine(models.Model):
                     "matched_credit_ids.credit_move_id"
                 )
                 if payment_lines:
-                    line.move_line_ids = payment_lines[0].ids
-                    if not line.concept:
-                        line.concept = _("Invoice: %s") % invoice.name
+                    matches.append(
+                        (
+                            line,
+                            payment_lines[0].ids,
+                            not line.concept and _("Invoice: %s") % invoice.name,
+                        )
+                    )
+        self._write_matches(matches)
 
     def match_move_lines(self):
+        references = self._get_match_references()
+        if not references:
+            return
+        all_move_lines = self.env["account.move.line"].search(
+            [
+                ("account_id.internal_type", "=", "receivable"),
+                ("reconciled", "=", True),
+                "|",
+                ("name", "in", references),
+                ("ref", "in", references),
+            ]
+        )
+        matches = []
         for line in self:
-            domain = line.partner_id and [("partner_id", "=", line.partner_id.id)] or []
-            if line.return_id.journal_id:
-                domain += [
-                    ("journal_id", "=", line.return_id.journal_id.id),
-                    ("move_id.move_type", "=", "entry"),
-                ]
-            domain.extend(
-                [
-                    ("account_id.internal_type", "=", "receivable"),
-                    ("reconciled", "=", True),
-                    "|",
-                    ("name", "=", line.reference),
-                    ("ref", "=", line.reference),
-                ]
+            journal = line.return_id.journal_id
+            move_lines = all_move_lines.filtered(
+                lambda ml: line.reference in (ml.name, ml.ref)
+                and (not line.partner_id or ml.partner_id == line.partner_id)
+                and (
+                    not journal
+                    or (ml.journal_id == journal and ml.move_id.move_type == "entry")
+                )
             )
-            move_lines = self.env["account.move.line"].search(domain)
             if move_lines:
-                line.move_line_ids = move_lines.ids
-                if not line.concept:
-                    line.concept = _("Move lines: %s") % ", ".join(
-                        move_lines.mapped("name")
+                matches.append(
+                    (
+                        line,
+                        move_lines.ids,
+                        not line.concept
+                        and _("Move lines: %s") % ", ".join(move_lines.mapped("name")),
                     )
+                )
+        self._write_matches(matches)
 
     def match_move(self):
+        references = self._get_match_references()
+        if not references:
+            return
+        moves = self.env["account.move"].search(
+            [("name", "in", references), ("move_type", "=", "entry")]
+        )
+        moves.mapped("line_ids")
+        matches = []
         for line in self:
-            domain = line.partner_id and [("partner_id", "=", line.partner_id.id)] or []
-            domain += [("name", "=", line.reference), ("move_type", "=", "entry")]
-            move = self.env["account.move"].search(domain)
+            move = moves.filtered(
+                lambda m: m.name == line.reference
+                and (not line.partner_id or m.partner_id == line.partner_id)
+            )
             if move:
-                line.move_line_ids = move.line_ids.filtered(
-                    lambda l: (l.account_internal_type == "receivable" and l.reconciled)
-                ).ids
-                if not line.concept:
-                    line.concept = _("Move: %s") % move.ref
+                matches.append(
+                    (
+                        line,
+                        move.line_ids.filtered(
+                            lambda l: (
+                                l.account_internal_type == "receivable" and l.reconciled
+                            )
+                        ).ids,
+                        not line.concept and _("Move: %s") % move.ref,
+                    )
+                )
+        self._write_matches(matches)
 
     def _find_match(self):
         # we filter again to remove all ready matched lines in inheritance
         lines2match = self.filtered(lambda x: ((not x.move_line_ids) and x.reference))
         lines2match.match_invoice()
-
-        lines2match = lines2match.filtered(
-            lambda x: ((not x.move_line_ids) and x.reference)
-        )
+        # the matchers never touch reference, so between passes it is
+        # enough to drop the lines that just got their move lines
+        lines2match = lines2match.filtered(lambda x: not x.move_line_ids)
         lines2match.match_move_lines()
 
-        lines2match = lines2match.filtered(
-            lambda x: ((not x.move_line_ids) and x.reference)
-        )
+        lines2match = lines2match.filtered(lambda x: not x.move_line_ids)
         lines2match.match_move()
         self._get_partner_from_move()
         self.filtered(lambda x: not x.amount)._compute_amount()